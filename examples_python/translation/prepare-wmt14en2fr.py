@@ -1,16 +1,25 @@
 import os
+import re
+import shlex
+import shutil
 import subprocess
+import time
 from pathlib import Path
 import sys
 import argparse
+from itertools import islice, zip_longest
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from urllib.parse import urlparse
 
+import regex
 from loguru import logger
+from sacremoses import MosesPunctNormalizer, MosesTokenizer
 
 
 DESCRIPTION = """Adapted from
     https://github.com/hnt4499/fairseq/blob/master/examples/translation/prepare-wmt14en2fr.sh
 Prepare data for WMT14 en-fr machine translation task, including:
-1. Clone `moses` and `subword-nmt` (if paths are not specified).
+1. Clone `subword-nmt` (if path is not specified).
 2. Download (and extract) raw data (train and test) (if paths not specified),
 and save to "`save_dir`/orig".
 3. Pre-process data and save to "`save_dir`/processed":
@@ -19,12 +28,13 @@ and save to "`save_dir`/orig".
     iii. Tokenize
     iv. Split train data into train and val data.
 4. Learn BPE from split training data and save to "`save_dir`/cleaned".
-5. Apply BPE to train/val/test data (and temporarily save to
-"`save_dir`/cleaned").
-6. Remove sentence pairs that either:
+5. Apply BPE to train/val/test data and, except for the test data, remove
+sentence pairs that either:
     i. has source/target or target/source ratio > 1.5
     ii. has source or target sentence length < 1 or > 250
 and save to "`save_dir`/cleaned"
+
+Requires `sacremoses` and `loguru` (`pip install sacremoses loguru`).
 """
 
 
@@ -39,6 +49,11 @@ URLS = [
     "http://statmt.org/wmt10/training-giga-fren.tar",
     "http://statmt.org/wmt14/test-full.tgz",
 ]
+# Maximum number of concurrent `wget` processes, and of `wget` batches per host
+DOWNLOAD_JOBS = 8
+EXTRACT_JOBS = 4  # maximum number of archives extracted concurrently
+# Use parallel gzip decompression if available
+PIGZ_AVAILABLE = shutil.which("pigz") is not None
 
 TRAIN_CORPORA = [
     # "europarl-v7.fr-en",
@@ -48,23 +63,312 @@ TRAIN_CORPORA = [
     # "giga-fren.release2.fixed",
 ]
 TEST_CORPUS = "newstest2014-fren-{}.{}.sgm"
+# Shards of parallel data processed by different workers start at multiples of
+# this number of lines
+SHARD_ALIGNMENT = 10000
+
+# Characters replaced with a space by `remove-non-printing-char.perl`. `regex`
+# (a dependency of `sacremoses`) supports Unicode properties, unlike `re`
+NON_PRINTING_CHAR = regex.compile(r"\p{C}")
+# Segment tags of the SGML test data
+SEG_START_TAG = re.compile(r'<seg id="[0-9]*">\s*')
+SEG_END_TAG = re.compile(r"\s*</seg>\s*")
 
 
 def execute(command):
     logger.info(f"Executing: {command}")
 
+    # Only stderr is captured (for error reporting), so that verbose output is
+    # not buffered in memory
     try:
-        subprocess.check_output(
-            command, shell=True, stderr=subprocess.STDOUT)
+        subprocess.run(
+            command, shell=True, check=True, stdout=subprocess.DEVNULL,
+            stderr=subprocess.PIPE)
     except subprocess.CalledProcessError as e:
         logger.info(
-            f"An error occured, exiting...:\n{e.output.decode('utf-8')}")
-        exit()
+            f"An error occured, exiting...:\n{e.stderr.decode('utf-8')}")
+        sys.exit(1)
+
+
+def _compile_regex_table(value):
+    """Compile `(pattern, substitution)` pairs (or lists of them) that older
+    sacremoses releases keep as raw strings and pass to `re.sub` on every
+    call. Anything else is returned unchanged."""
+    if (isinstance(value, tuple) and len(value) == 2
+            and isinstance(value[0], str) and isinstance(value[1], str)):
+        return re.compile(value[0]), value[1]
+    if isinstance(value, list) and value and all(
+            isinstance(item, tuple) for item in value):
+        return [_compile_regex_table(item) for item in value]
+    return value
+
+
+class FastMosesTokenizer(MosesTokenizer):
+    """`MosesTokenizer` with its regex tables and character sets built once at
+    import time. `MosesTokenizer.islower` and `MosesTokenizer.isanyalpha` turn
+    the (large) character classes into sets on every call, which dominates the
+    tokenization of sentences with many tokens ending with a period."""
+
+    IS_LOWER = frozenset(MosesTokenizer.IsLower)
+
+    def __init__(self, lang="en"):
+        super(FastMosesTokenizer, self).__init__(lang=lang)
+        # `IsAlpha` is extended per instance for CJK languages
+        self.is_alpha = frozenset(self.IsAlpha)
+        self.NONBREAKING_PREFIXES = frozenset(self.NONBREAKING_PREFIXES)
+        self.NUMERIC_ONLY_PREFIXES = frozenset(self.NUMERIC_ONLY_PREFIXES)
+
+    def islower(self, text):
+        return self.IS_LOWER.issuperset(text)
+
+    def isanyalpha(self, text):
+        return not self.is_alpha.isdisjoint(text)
+
+
+for _name, _value in list(vars(MosesTokenizer).items()):
+    if _name.isupper():
+        setattr(FastMosesTokenizer, _name, _compile_regex_table(_value))
+
+
+def preprocess_line(line, normalizer, tokenizer):
+    """In-process equivalent of `normalize-punctuation.perl |
+    remove-non-printing-char.perl | tokenizer.perl -a`."""
+    line = normalizer.normalize(line.rstrip("\n"))
+    line = NON_PRINTING_CHAR.sub(" ", line)
+    return tokenizer.tokenize(
+        line, aggressive_dash_splits=True, return_str=True)
+
+
+def extract_archive(arc_filepath, dest_dir):
+    _, arc_filename = os.path.split(arc_filepath)
+    if arc_filename.endswith(".tgz"):
+        if PIGZ_AVAILABLE:
+            execute(f"tar -I pigz -xf {arc_filepath} -C {dest_dir}")
+        else:
+            execute(f"tar xzf {arc_filepath} -C {dest_dir}")
+    elif arc_filename.endswith(".tar"):
+        # This is `giga-fren.release2.fixed`
+        execute(f"tar xf {arc_filepath} -C {dest_dir}")
+        # After extracting the tarball, we need to further extract the gunzip
+        for gunzip_path in Path(dest_dir).glob(
+                "giga-fren.release2.fixed.*.gz"):
+            execute(f"pigz -d {gunzip_path}" if PIGZ_AVAILABLE
+                    else f"gunzip {gunzip_path}")
+
+
+def download_and_extract(urls, dest_dir):
+    """Download `urls` to `dest_dir` and extract each archive as soon as the
+    `wget` batch that fetched it is done. URLs of the same host are split into
+    at most `DOWNLOAD_JOBS` batches, each fetched by a single `wget` that keeps
+    the connection alive between files. Exit as soon as any download fails,
+    without waiting for the others."""
+    urls_by_host = {}
+    for url in urls:
+        urls_by_host.setdefault(urlparse(url).netloc, []).append(url)
+    pending = []
+    for host_urls in urls_by_host.values():
+        num_batches = min(DOWNLOAD_JOBS, len(host_urls))
+        pending.extend(host_urls[i::num_batches] for i in range(num_batches))
+
+    running = {}  # `wget` process -> its batch of URLs
+    extractor = ThreadPoolExecutor(max_workers=EXTRACT_JOBS)
+    extractions = []
+    try:
+        while pending or running:
+            while pending and len(running) < DOWNLOAD_JOBS:
+                batch = pending.pop(0)
+                command = ["wget", "-nc", "-nv", "--timeout=60", "--tries=2",
+                           "-P", dest_dir] + batch
+                logger.info(f"Executing: {' '.join(command)}")
+                # No shell, so that the `wget` process itself can be killed
+                process = subprocess.Popen(
+                    command, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+                running[process] = batch
+
+            time.sleep(1)
+            for process, batch in list(running.items()):
+                returncode = process.poll()
+                if returncode is None:
+                    continue
+                del running[process]
+                if returncode != 0:
+                    logger.info(f"An error occured, exiting...:\n"
+                                f"{process.stderr.read().decode('utf-8')}")
+                    sys.exit(1)
+                for url in batch:
+                    _, arc_filename = os.path.split(url)
+                    extractions.append(extractor.submit(
+                        extract_archive, os.path.join(dest_dir, arc_filename),
+                        dest_dir))
+
+        for future in extractions:
+            future.result()
+    finally:
+        # Only does anything if exiting early
+        for process in running:
+            process.kill()
+        for future in extractions:
+            future.cancel()
+        extractor.shutdown(wait=False)
+
+
+# Per-process normalizers and tokenizers, shared by all jobs of a language
+_moses_processors = {}
+
+
+def get_moses_processors(lang):
+    if lang not in _moses_processors:
+        _moses_processors[lang] = (
+            MosesPunctNormalizer(lang=lang), FastMosesTokenizer(lang=lang))
+    return _moses_processors[lang]
+
+
+def tokenize_file(lang, raw_filepath, dest_filepath):
+    normalizer, moses_tokenizer = get_moses_processors(lang)
+
+    # Only "\n" ends a line: a stray "\r" would otherwise split the line and
+    # misalign the parallel corpora (the normalizer removes it, like
+    # `normalize-punctuation.perl`)
+    with open(raw_filepath, encoding="utf-8", newline="\n") as fin, \
+            open(dest_filepath, "w", encoding="utf-8") as fout:
+        for line in fin:
+            line = preprocess_line(line, normalizer, moses_tokenizer)
+            fout.write(f"{line}\n")
+
+
+def tokenize_sgm_file(lang, raw_filepath, dest_filepath):
+    """In-process equivalent of `grep '<seg id' | sed` (to strip the segment
+    tags and replace "’" with "'") `| tokenizer.perl -a`."""
+    _, moses_tokenizer = get_moses_processors(lang)
+
+    # Like `grep`, only split lines on "\n"
+    with open(raw_filepath, encoding="utf-8", newline="\n") as fin, \
+            open(dest_filepath, "w", encoding="utf-8") as fout:
+        for line in fin:
+            if "<seg id" not in line:
+                continue
+            line = SEG_START_TAG.sub("", line.rstrip("\n"))
+            line = SEG_END_TAG.sub("", line).replace("\u2019", "'")
+            line = moses_tokenizer.tokenize(
+                line, aggressive_dash_splits=True, return_str=True)
+            fout.write(f"{line}\n")
+
+
+# BPE of the current worker process, loaded once by `init_bpe`
+_bpe = None
+
+
+def init_bpe(code_path, subword_nmt):
+    global _bpe
+    # `subword_nmt` is the package directory, i.e., `subword-nmt/subword_nmt`
+    sys.path.insert(0, os.path.dirname(subword_nmt))
+    from subword_nmt.apply_bpe import BPE
+
+    with open(code_path, encoding="utf-8") as fin:
+        _bpe = BPE(fin)
+
+
+def apply_bpe(src_filepath, dest_filepath):
+    with open(src_filepath, encoding="utf-8") as fin, \
+            open(dest_filepath, "w", encoding="utf-8") as fout:
+        for line in fin:
+            fout.write(_bpe.process_line(line))
+
+
+def keep_sentence_pair(src_words, tgt_words, ratio=1.5, min_len=1,
+                       max_len=250):
+    """Same criteria as `clean-corpus-n.perl -ratio {ratio} ... {min_len}
+    {max_len}`."""
+    src_len, tgt_len = len(src_words), len(tgt_words)
+    return (min_len <= src_len <= max_len and min_len <= tgt_len <= max_len
+            and src_len / tgt_len <= ratio and tgt_len / src_len <= ratio)
+
+
+def apply_bpe_and_clean(src_filepaths, dest_filepaths, offsets=(0, 0),
+                        num_lines=None):
+    """Apply BPE to a pair of parallel files and write only the sentence pairs
+    kept by `keep_sentence_pair`, in a single pass over the data. Only
+    `num_lines` pairs starting at the byte `offsets` of the two files are
+    processed, or all remaining pairs if `num_lines` is `None`. Return the
+    number of input and output sentence pairs."""
+    num_inputs = num_outputs = 0
+    src_filepath, tgt_filepath = src_filepaths
+    dest_src_filepath, dest_tgt_filepath = dest_filepaths
+
+    with open(src_filepath, "rb") as src_fin, \
+            open(tgt_filepath, "rb") as tgt_fin, \
+            open(dest_src_filepath, "w", encoding="utf-8") as src_fout, \
+            open(dest_tgt_filepath, "w", encoding="utf-8") as tgt_fout:
+        src_fin.seek(offsets[0])
+        tgt_fin.seek(offsets[1])
+        src_lines = islice(src_fin, num_lines)
+        tgt_lines = islice(tgt_fin, num_lines)
+
+        for src_line, tgt_line in zip_longest(src_lines, tgt_lines):
+            # Like `clean-corpus-n.perl`, refuse to silently truncate
+            if src_line is None or tgt_line is None:
+                raise ValueError(
+                    f"{src_filepath} and {tgt_filepath} have different "
+                    f"numbers of lines")
+            num_inputs += 1
+            # Like `clean-corpus-n.perl`, remove factor separators and
+            # normalize whitespaces before counting words
+            src_words = _bpe.segment(
+                src_line.decode("utf-8")).replace("|", "").split()
+            tgt_words = _bpe.segment(
+                tgt_line.decode("utf-8")).replace("|", "").split()
+            if keep_sentence_pair(src_words, tgt_words):
+                num_outputs += 1
+                src_fout.write(" ".join(src_words) + "\n")
+                tgt_fout.write(" ".join(tgt_words) + "\n")
+
+    return num_inputs, num_outputs
+
+
+def index_parallel_files(src_filepaths, every=SHARD_ALIGNMENT):
+    """Read a pair of parallel files together, once, and return the byte
+    offsets in both files of every `every`-th line (starting at line 0). Raise
+    an error if they have different numbers of lines."""
+    src_filepath, tgt_filepath = src_filepaths
+    offsets = [(0, 0)]
+    src_offset = tgt_offset = num_lines = 0
+
+    with open(src_filepath, "rb") as src_fin, \
+            open(tgt_filepath, "rb") as tgt_fin:
+        for src_line, tgt_line in zip_longest(src_fin, tgt_fin):
+            if src_line is None or tgt_line is None:
+                raise ValueError(
+                    f"{src_filepath} and {tgt_filepath} have different "
+                    f"numbers of lines")
+            src_offset += len(src_line)
+            tgt_offset += len(tgt_line)
+            num_lines += 1
+            if num_lines % every == 0:
+                offsets.append((src_offset, tgt_offset))
+    return offsets
+
+
+def concatenate_files(src_filepaths, dest_filepath):
+    """Concatenate `src_filepaths` into `dest_filepath` and remove them."""
+    with open(dest_filepath, "wb") as fout:
+        for src_filepath in src_filepaths:
+            with open(src_filepath, "rb") as fin:
+                shutil.copyfileobj(fin, fout)
+            os.remove(src_filepath)
+
+
+def resolve_dir(path):
+    """Return the real path of `path` if it is an existing directory, and
+    `None` otherwise."""
+    if path is None:
+        return None
+    path = os.path.realpath(path)
+    return path if os.path.isdir(path) else None
 
 
 def remove_if_exists(path, ask=False):
-    if os.path.exists(path):
-        if ask:
+    if ask:
+        if os.path.exists(path):
             prompt = f"File existed: {path}. Overwrite? (y/n) "
             inp = input(prompt)
             while inp not in ["y", "n"]:
@@ -74,8 +378,12 @@ def remove_if_exists(path, ask=False):
                 os.remove(path)
             else:
                 return False
-        else:
+    else:
+        # No need to check for existence beforehand
+        try:
             os.remove(path)
+        except FileNotFoundError:
+            pass
     return True
 
 
@@ -89,67 +397,49 @@ def main(args):
     logger.add(logger_path, mode="w",
                format="{time:YYYY-MM-DD at HH:mm:ss} | {message}")
 
-    # Moses
-    if args.moses_path is None or not os.path.isdir(args.moses_path):
-        logger.info("Cloning Moses github repository to the current working "
-                    "directory (for tokenization scripts)...")
-        execute("git clone https://github.com/moses-smt/mosesdecoder.git")
-        moses_path = os.path.realpath("./mosesdecoder/scripts")
-    else:
-        logger.info(f"Moses scripts found at {args.moses_path}")
-        moses_path = os.path.realpath(args.moses_path)
-    # Script paths
-    tokenizer = os.path.join(moses_path, "tokenizer/tokenizer.perl")
-    cleaner = os.path.join(moses_path, "training/clean-corpus-n.perl")
-    norm_punc = os.path.join(
-        moses_path, "tokenizer/normalize-punctuation.perl")
-    rem_non_print_char = os.path.join(
-        moses_path, "tokenizer/remove-non-printing-char.perl")
+    if args.moses_path is not None:
+        logger.warning("`--moses-path` is deprecated and ignored, as the Moses "
+                       "scripts are no longer used.")
+
+    # Resolve optional paths once
+    subword_nmt = resolve_dir(args.subword_nmt)
+    orig_save_dir = resolve_dir(args.orig_dir)
 
     # Subword NMT
-    if args.subword_nmt is None or not os.path.isdir(args.subword_nmt):
+    if subword_nmt is None:
         logger.info("Cloning Subword NMT repository to the current working "
                     "directory (for BPE pre-processing)...")
         execute("git clone https://github.com/rsennrich/subword-nmt.git")
         subword_nmt = os.path.realpath("./subword-nmt/subword_nmt")
     else:
-        logger.info(f"Subword NMT scripts found at {args.subword_nmt}")
-        subword_nmt = os.path.realpath(args.subword_nmt)
+        logger.info(f"Subword NMT scripts found at {subword_nmt}")
 
     save_dir = os.path.realpath(args.save_dir)
     # Original data
-    if args.orig_dir is None or not os.path.isdir(args.orig_dir):
+    if orig_save_dir is None:
         orig_save_dir = os.path.join(save_dir, "orig")
         os.makedirs(orig_save_dir, exist_ok=True)
         logger.info(f"Original data not found. Downloading and extracting to "
                     f"{orig_save_dir}...")
 
-        for url in URLS:
-            # Download
-            execute(f"wget {url} -P {orig_save_dir}")
-            # Extract
-            _, arc_filename = os.path.split(url)
-            arc_filepath = os.path.join(orig_save_dir, arc_filename)
-            if arc_filename.endswith(".tgz"):
-                execute(f"tar xvzf {arc_filepath}")
-            elif arc_filename.endswith(".tar"):
-                # This is `giga-fren.release2.fixed`
-                execute(f"tar xvf {arc_filepath}")
-                # After extracting the tarball, we need to further extract
-                # the gunzip
-                for gunzip_path in Path("./").glob(
-                        "giga-fren.release2.fixed.*.gz"):
-                    execute(f"gunzip {gunzip_path}")
+        download_and_extract(URLS, orig_save_dir)
     else:
-        orig_save_dir = os.path.realpath(args.orig_dir)
         logger.info(f"Original data found at {orig_save_dir}")
 
+    # Index the original data once rather than walking the whole directory
+    # tree for every file lookup
+    orig_filepaths = {}
+    for root, _, filenames in os.walk(orig_save_dir):
+        for filename in filenames:
+            orig_filepaths.setdefault(filename, os.path.join(root, filename))
+
     # Preprocess train data
     processed_save_dir = os.path.join(save_dir, "processed")
     os.makedirs(processed_save_dir, exist_ok=True)
-    logger.info(
-        f"Pre-processing train data and save to {processed_save_dir}...")
+    logger.info(f"Pre-processing train and test data and save to "
+                f"{processed_save_dir}...")
 
+    tokenize_jobs = {}  # (lang, dest_filepath) -> [(raw, part_filepath)]
     for lang in [SRC_LANG, TGT_LANG]:
         dest_filepath = os.path.join(
             processed_save_dir,
@@ -159,33 +449,41 @@ def main(args):
             logger.info(f"File existed: {dest_filepath}. Skipping...")
             continue
 
-        for raw_filename in TRAIN_CORPORA:
-            raw_filepath = list(Path(orig_save_dir).rglob(
-                f"{raw_filename}.{lang}"))[0]
-
-            cmd = (
-                f"cat {raw_filepath} | perl {norm_punc} {lang} | perl "
-                f"{rem_non_print_char} | perl {tokenizer} --threads 8 -a -l "
-                f"{lang} >> {dest_filepath}"
-            )
-            execute(cmd)
+        # Each corpus is tokenized to a separate part file in parallel, and
+        # the parts are then concatenated in the order of `TRAIN_CORPORA`
+        tokenize_jobs[(lang, dest_filepath)] = [
+            (orig_filepaths[f"{raw_filename}.{lang}"],
+             f"{dest_filepath}.part{i}")
+            for i, raw_filename in enumerate(TRAIN_CORPORA)
+        ]
 
     processed_filepaths = {"train": [], "val": [], "test": []}
 
-    # Preprocess test data
-    for lang, source in [(SRC_LANG, "src"), (TGT_LANG, "ref")]:
-        raw_filename = TEST_CORPUS.format(source, lang)
-        raw_filepath = list(Path(orig_save_dir).rglob(raw_filename))[0]
-        dest_filepath = (f"{processed_save_dir}/test."
-                         f"{SRC_LANG}-{TGT_LANG}.{lang}")
-        cmd = (
-            f"grep '<seg id' {raw_filepath} | sed -e "
-            f"'s/<seg id=\"[0-9]*\">\\s*//g' | sed -e 's/\\s*<\\/seg>\\s*//g' "
-            f"| sed -e \"s/\\’/\\'/g\" | perl {tokenizer} -threads 8 -a -l "
-            f"{lang} > {dest_filepath}"
-        )
-        execute(cmd)
-        processed_filepaths["test"].append(dest_filepath)
+    with ProcessPoolExecutor(max_workers=os.cpu_count()) as executor:
+        futures = []
+        for (lang, _), parts in tokenize_jobs.items():
+            for raw_filepath, part_filepath in parts:
+                logger.info(f"Tokenizing {raw_filepath}")
+                futures.append(executor.submit(
+                    tokenize_file, lang, raw_filepath, part_filepath))
+
+        # Preprocess test data
+        for lang, source in [(SRC_LANG, "src"), (TGT_LANG, "ref")]:
+            raw_filename = TEST_CORPUS.format(source, lang)
+            raw_filepath = orig_filepaths[raw_filename]
+            dest_filepath = (f"{processed_save_dir}/test."
+                             f"{SRC_LANG}-{TGT_LANG}.{lang}")
+            logger.info(f"Tokenizing {raw_filepath}")
+            futures.append(executor.submit(
+                tokenize_sgm_file, lang, raw_filepath, dest_filepath))
+            processed_filepaths["test"].append(dest_filepath)
+
+        for future in futures:
+            future.result()
+
+    for (_, dest_filepath), parts in tokenize_jobs.items():
+        concatenate_files(
+            [part_filepath for _, part_filepath in parts], dest_filepath)
 
     # Data splitting
     logger.info(f"Splitting train and valid data to {processed_save_dir}...")
@@ -197,79 +495,103 @@ def main(args):
         dest_val_filepath = (f"{processed_save_dir}/val.processed."
                              f"{SRC_LANG}-{TGT_LANG}.{lang}")
 
-        cmd = ("awk '{if (NR%1333 == 0)  print $0; }' "
-               f"{src_filepath} > {dest_val_filepath}")
+        # Write both splits in a single pass over `src_file`
+        cmd = (f"awk -v val={dest_val_filepath} -v train={dest_train_filepath} "
+               "'{if (NR%1333 == 0)  print $0 > val; else print $0 > train; }' "
+               f"{src_filepath}")
         execute(cmd)
         processed_filepaths["val"].append(dest_val_filepath)
-
-        cmd = ("awk '{if (NR%1333 != 0)  print $0; }' "
-               f"{src_filepath} > {dest_train_filepath}")
-        execute(cmd)
         processed_filepaths["train"].append(dest_train_filepath)
 
         # Remove `src_file`, which is unsplit data
         execute(f"rm {src_filepath}")
 
-    # Merge two train files into one to learn BPE
-    logger.info("Merging two train files into one to learn BPE from it...")
-    merged_filepath = (f"{processed_save_dir}/train.processed."
-                       f"{SRC_LANG}-{TGT_LANG}")
-    remove_if_exists(merged_filepath)
-
-    for processed_filepath in processed_filepaths["train"]:
-        execute(f"cat {processed_filepath} >> {merged_filepath}")
-
     # Learn BPE
     cleaned_path = os.path.join(save_dir, "cleaned")
     os.makedirs(cleaned_path, exist_ok=True)
 
     code_path = os.path.join(cleaned_path, "code")
-    logger.info(f"Learn BPE on {merged_filepath} and save code to {code_path}")
-    cmd = (f"python {subword_nmt}/learn_bpe.py -s "
-           f"{args.bpe_tokens} < {merged_filepath} > {code_path}")
+    # Stream the concatenated train files instead of merging them on disk
+    train_filepaths = " ".join(processed_filepaths["train"])
+    logger.info(f"Learn BPE on {train_filepaths} and save code to {code_path}")
+    cmd = (f"cat {train_filepaths} | python {subword_nmt}/learn_bpe.py -s "
+           f"{args.bpe_tokens} > {code_path}")
+    # Fail if `cat` fails, not only if `learn_bpe.py` does
+    cmd = f"bash -o pipefail -c {shlex.quote(cmd)}"
     execute(cmd)
 
-    # Apply BPE
+    # Apply BPE and clean data in parallel with the code table loaded once per
+    # worker. Train and val data are split into line-aligned shards, each
+    # processed by a separate worker and then concatenated in order
+    logger.info("Applying learned BPE code and cleaning data...")
     file_pairs = []
-    for source, filepaths in processed_filepaths.items():
-        for src_filepath in filepaths:
-            src_filedir, src_filename = os.path.split(src_filepath)
-            dest_filepath = os.path.join(src_filedir, f"bpe.{src_filename}")
-
-            logger.info(f"Applying learned BPE code to {src_filepath}")
-            cmd = (f"python {subword_nmt}/apply_bpe.py -c {code_path} < "
-                   f"{src_filepath} > {dest_filepath}")
-            execute(cmd)
-
-            pair_filename, _ = os.path.splitext(dest_filepath)
-            file_pairs.append(pair_filename)
-
-    # Clean data
-    logger.info("Cleaning data...")
-    file_pairs_ = []
-    for src_file_pair in set(file_pairs):
-        _, file_pair = os.path.split(src_file_pair)
-        dest_file_pair = os.path.join(  # remove the ".processed" part
-            cleaned_path, file_pair.replace(".processed", ""))
-        file_pairs_.append(dest_file_pair)
-
-        # Don't clean the test data
-        if "test" in src_file_pair:
-            for lang in [SRC_LANG, TGT_LANG]:
-                execute(f"cp {src_file_pair}.{lang} "
-                        f"{dest_file_pair}.{lang}")
-
-        else:
-            cmd = (f"perl {cleaner} -ratio 1.5 {src_file_pair} {SRC_LANG} "
-                   f"{TGT_LANG} {dest_file_pair} 1 250")
-            execute(cmd)
+    with ProcessPoolExecutor(
+            max_workers=os.cpu_count(), initializer=init_bpe,
+            initargs=(code_path, subword_nmt)) as executor:
+        test_futures = []
+        clean_jobs = {}  # file_pair -> (dest_filepaths, [(parts, future)])
+        for source, filepaths in processed_filepaths.items():
+            file_pair = os.path.join(
+                cleaned_path, f"bpe.{source}.{SRC_LANG}-{TGT_LANG}")
+            dest_filepaths = [f"{file_pair}.{lang}"
+                              for lang in [SRC_LANG, TGT_LANG]]
+            file_pairs.append(file_pair)
+
+            # Don't clean the test data
+            if source == "test":
+                for src_filepath, dest_filepath in zip(
+                        filepaths, dest_filepaths):
+                    logger.info(
+                        f"Applying learned BPE code to {src_filepath}")
+                    test_futures.append(executor.submit(
+                        apply_bpe, src_filepath, dest_filepath))
+            else:
+                logger.info(f"Applying learned BPE code to and cleaning "
+                            f"{' and '.join(filepaths)}")
+                # Also checks that both files have the same number of lines
+                # before any work is sent to the pool
+                aligned_offsets = index_parallel_files(filepaths)
+                num_shards = min(os.cpu_count(), len(aligned_offsets))
+                # Index in `aligned_offsets` of the first line of each shard
+                starts = [len(aligned_offsets) * i // num_shards
+                          for i in range(num_shards)]
+                shard_offsets = [aligned_offsets[start] for start in starts]
+
+                shards = []
+                for i, offsets in enumerate(shard_offsets):
+                    part_filepaths = [f"{dest_filepath}.part{i}"
+                                      for dest_filepath in dest_filepaths]
+                    # The last shard reads until the end of both files, so
+                    # that any leftover lines are detected
+                    shard_lines = (
+                        (starts[i + 1] - starts[i]) * SHARD_ALIGNMENT
+                        if i + 1 < num_shards else None)
+                    shards.append((part_filepaths, executor.submit(
+                        apply_bpe_and_clean, filepaths, part_filepaths,
+                        offsets, shard_lines)))
+                clean_jobs[file_pair] = (dest_filepaths, shards)
+
+        for future in test_futures:
+            future.result()
+        for file_pair, (dest_filepaths, shards) in clean_jobs.items():
+            num_inputs = num_outputs = 0
+            for _, future in shards:
+                shard_inputs, shard_outputs = future.result()
+                num_inputs += shard_inputs
+                num_outputs += shard_outputs
+            for j, dest_filepath in enumerate(dest_filepaths):
+                concatenate_files(
+                    [part_filepaths[j] for part_filepaths, _ in shards],
+                    dest_filepath)
+            logger.info(f"{file_pair}: input sentences: {num_inputs}, output "
+                        f"sentences: {num_outputs}")
 
     # Binarize data
     if args.binarize:
         logger.info("Binarizing data...")
         binarized_path = os.path.join(save_dir, "binarized")
         os.makedirs(binarized_path, exist_ok=True)
-        train_pref, val_pref, test_pref = file_pairs_
+        train_pref, val_pref, test_pref = file_pairs
 
         cmd = (
             f"fairseq-preprocess --source-lang {SRC_LANG} --target-lang "
@@ -287,9 +609,8 @@ def parse_arguments(argv):
         description=DESCRIPTION)
     parser.add_argument(
         "-m", "--moses-path", type=str, required=False, default=None,
-        help="Path to the `mosesdecoder/scripts` directory. Automatically "
-             "clone from GitHub to the current working directory if not "
-             "speficied.")
+        help="Deprecated and ignored: tokenization and cleaning no longer use "
+             "the Moses scripts. Kept for backward compatibility.")
     parser.add_argument(
         "-s", "--subword-nmt", type=str, required=False, default=None,
         help="Path to the `subword-nmt/subword_nmt` directory. Automatically "
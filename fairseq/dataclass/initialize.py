@@ -19,10 +19,10 @@ def hydra_init(cfg_name="config") -> None:
     cs = ConfigStore.instance()
     cs.store(name=cfg_name, node=FairseqConfig)
 
-    for k in FairseqConfig.__dataclass_fields__:
-        v = FairseqConfig.__dataclass_fields__[k].default
+    for k, field in FairseqConfig.__dataclass_fields__.items():
+        v = field.default
         try:
             cs.store(name=k, node=v)
-        except BaseException:
+        except Exception:
             logger.error(f"{k} - {v}")
             raise
@@ -1,25 +1,29 @@
 """Loguru utils"""
 
+from loguru._datetime import aware_now
+from loguru._recattrs import RecordLevel
+
 # List of files in `fairseq_cli` that use logging. Any files other than these
 # attempting to use logging will have their logger with the same file name
 # (i.e., `__name__`).
 name_list = ["eval_lm", "generate", "hydra_train", "interactive", "preprocess",
              "train", "validate"]
+name_set = frozenset(name_list)  # for fast lookup in `loguru_name_patcher`
 
 
 def loguru_name_patcher(record):
-    filename = record["file"].name  # filename, e.g., `train.py`
-    name = ".".join(filename.split(".")[:-1])  # remove the ".py" part
-    if name in name_list:
+    # Remove the ".py" part of the filename, e.g., `train.py`
+    name = record["file"].name.rpartition(".")[0]
+    if name in name_set:
         name = f"fairseq_cli.{name}"  # legacy name, e.g., `fairseq_cli.train`
-    record["extra"].update(name=name)
+    record["extra"]["name"] = name
 
 
 def loguru_reset_logger(logger):
     """Remove all handlers"""
-    handlers_count = logger._core.handlers
-    for _ in range(len(handlers_count)):
-        logger.remove()
+    # Snapshot the IDs since `logger.remove` mutates the handler dict
+    for handler_id in list(logger._core.handlers.keys()):
+        logger.remove(handler_id)
 
 
 class LoguruLevels:
@@ -41,11 +45,9 @@ def loguru_set_level(logger, level):
 
 def get_effective_level(logger):
     """Get effective level of the logger by finding the smallest level among
-    all handlers."""
-    levels = []
-    for handler in logger._core.handlers.values():
-        levels.append(handler.levelno)
-    return min(levels)
+    all handlers, or `LoguruLevels.CRITICAL` if there is no handler."""
+    return min((handler.levelno for handler in logger._core.handlers.values()),
+               default=LoguruLevels.CRITICAL)
 
 
 def loguru_emit_some_handlers(logger, handler_ids, message, name,
@@ -67,20 +69,19 @@ def loguru_emit_some_handlers(logger, handler_ids, message, name,
         Level name.
 
     """
-    from loguru._recattrs import RecordLevel
-    from loguru._datetime import aware_now
-
     core = logger._core
     level_name, level_no, _, level_icon = core.levels[level_id]
 
+    # Handlers copy the record before formatting it, so, like loguru itself,
+    # emit the same record to all of them
+    log_record = {
+        "message": message,
+        "level": RecordLevel(level_name, level_no, level_icon),
+        "exception": None,
+        "time": aware_now(),
+        "extra": {"name": name},
+    }
     for handler_id in handler_ids:
         handler = core.handlers[handler_id]
-        log_record = {
-            "message": message,
-            "level": RecordLevel(level_name, level_no, level_icon),
-            "exception": None,
-            "time": aware_now(),
-            "extra": {"name": name},
-        }
         handler.emit(log_record, level_id, from_decorator=False, is_raw=False,
                      colored_message=None)